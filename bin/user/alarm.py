@@ -7,11 +7,19 @@ AlarmSvc: weewx service for alarms. at present, email is the only action taken
 """
 
 import ast
-import configobj
+import builtins
+import collections
+import concurrent.futures
+import functools
 import getpass
 import smtplib
+import string
+import sys
+import symtable
 from email.mime.text import MIMEText
+from email.utils import getaddresses
 import logging
+import queue
 import threading
 
 import weewx
@@ -22,6 +30,19 @@ from weeutil.weeutil import timestamp_to_string, to_bool
 log = logging.getLogger(__name__)
 version = "4.0.4"
 
+# builtin functions that rules may use
+_SAFE_BUILTINS = {f.__name__: f for f in (
+        abs, all, any, bool, divmod, float, int, len, max, min, pow, range,
+        round, sorted, str, sum, tuple)}
+
+# other builtins, which a rule would otherwise mistake for (never present)
+# packet variables
+_UNSAFE_BUILTINS = frozenset(dir(builtins)) - _SAFE_BUILTINS.keys()
+
+# globals of every compiled rule function, so rules see only the allowed
+# builtins
+_RULE_GLOBALS = {'__builtins__': _SAFE_BUILTINS}
+
 
 class AlarmSvc(StdService):
     """
@@ -54,7 +75,8 @@ class AlarmSvc(StdService):
         subject         default notification email subject line, as a format
                         string evaluated in the context of the packet
                         converted to the specified unit system - it supports
-                        the '{var}' syntax to substitutes variables.
+                        the '{var}' syntax to substitutes variables. a
+                        variable not in the packet is left as '{var}'.
                         special variables are defined:
                             _NAME   alarm name
                             _RULE   rule (python expression) performed
@@ -77,7 +99,10 @@ class AlarmSvc(StdService):
                         is met, otherwise false. it is evaluated in the
                         context of the current packet converted to the defined
                         unit_system, so can include data_types, literals and
-                        _builtins_ functions
+                        these builtin functions: abs, all, any, bool, divmod,
+                        float, int, len, max, min, pow, range, round, sorted,
+                        str, sum, tuple. a rule using any other builtin
+                        is rejected at startup
             # on transition from false to true
             [[[on_set]]]
                 recipients  overrides default {recipients} if present
@@ -151,53 +176,65 @@ class AlarmSvc(StdService):
     def __init__(self, engine, config_dict):
         super(AlarmSvc, self).__init__(engine, config_dict)
 
-        log.debug(f"{self.__class__.__name__}: starting (version {version})")
+        log.debug("%s: starting (version %s)", self.__class__.__name__,
+                  version)
         if 'Alarms' not in config_dict:
             log.error(f"{self.__class__.__name__}: Alarms section not found")
             return      # slip away without becoming a packet listener
 
         mgr_sect = config_dict['Alarms']
+        # plain dict of the scalar options, read once. alarm definitions
+        # are the sub-sections, handled below
+        opts = {key: mgr_sect[key] for key in mgr_sect.scalars}
 
         # unit system
-        key = mgr_sect.get('unit_system', 'METRIC')
+        key = opts.get('unit_system', 'METRIC')
         if key not in weewx.units.unit_constants:
             log.error(f"{self.__class__.__name__}: invalid unit_system: {key}")
             return      # slip away without becoming a packet listener
         self.unit_system = weewx.units.unit_constants[key]
 
         # email service
-        server = mgr_sect.get('server', 'localhost')
-        user = mgr_sect.get('user', None)
-        password = mgr_sect.get('password', None)
-        sender = mgr_sect.get('sender', AlarmSvc.owner_emailaddr())
-        mailer = Mailer(server, user, password, sender)
+        server = opts.get('server', 'localhost')
+        user = opts.get('user', None)
+        password = opts.get('password', None)
+        sender = opts.get('sender') or AlarmSvc.owner_emailaddr()
+        self.mailer = mailer = Mailer(server, user, password, sender)
 
         # on_... sub-section defaults.
-        # all default strings non-literal i.e. need to be ast.literal_eval'ed
+        # all default strings non-literal i.e. need escapes interpreted
         on_defaults = dict()
-        key='recipients'; on_defaults[key] = mgr_sect.get(key, list())
-        key='text_set'; on_defaults[key] = mgr_sect.get(key, "SET")
-        key='text_clear'; on_defaults[key] = mgr_sect.get(key, "CLR")
-        key='notify_first'; on_defaults[key] = mgr_sect.get(key, '').lower()
-        key='subject_prefix'; on_defaults[key] = mgr_sect.get(key,
+        key='recipients'; on_defaults[key] = opts.get(key, list())
+        key='text_set'; on_defaults[key] = opts.get(key, "SET")
+        key='text_clear'; on_defaults[key] = opts.get(key, "CLR")
+        key='notify_first'; on_defaults[key] = opts.get(key, list())
+        key='subject_prefix'; on_defaults[key] = opts.get(key,
                                     r"Alarm [{_STATE}] ")
-        key='subject'; on_defaults[key] = mgr_sect.get(key, r"{_NAME}")
-        key='body_prefix'; on_defaults[key] = mgr_sect.get(key,
+        key='subject'; on_defaults[key] = opts.get(key, r"{_NAME}")
+        key='body_prefix'; on_defaults[key] = opts.get(key,
                                     r"Alarm:\t{_NAME}\nState:\t{_STATE}\n"
                                     r"Test:\t{_RULE}\nTime:\t{_TIME}\n")
-        key='body'; on_defaults[key] = mgr_sect.get(key, r"")
+        key='body'; on_defaults[key] = opts.get(key, r"")
+
+        # notify_first as a set of states. configobj gives a list if the
+        # value contains commas, otherwise a string
+        states = on_defaults['notify_first']
+        if isinstance(states, str):
+            states = states.split(',')
+        on_defaults['notify_first'] = frozenset(state.strip().lower()
+                                                for state in states)
 
         # create alarm definitions.
         # there is no particular relationship between or sequence of alarms
         alarm_defs_count = 0
         self.alarms = []
-        for alarm_name, alarm_sect in mgr_sect.items():
-            if isinstance(alarm_sect, configobj.Section):
-                alarm_defs_count += 1
-                alarm = self.parse_alarm(alarm_name, alarm_sect, on_defaults,
-                                         mailer)
-                if alarm:
-                    self.alarms.append(alarm)
+        for alarm_name in mgr_sect.sections:
+            alarm_defs_count += 1
+            alarm = self.parse_alarm(alarm_name, mgr_sect[alarm_name],
+                                     on_defaults, mailer)
+            if alarm:
+                self.alarms.append(alarm)
+        self.alarms = tuple(self.alarms)    # fixed from here on
 
         # any work to do?
         if not self.alarms:
@@ -208,6 +245,22 @@ class AlarmSvc(StdService):
         # create 'stop' signal to threads
         self.stop = threading.Event()
 
+        # start the one long-lived thread that assesses ARCHIVE packets, to
+        # protect the engine thread. packets reach it via the work queue,
+        # which is bounded in case assessment stalls (e.g. on SMTP relay)
+        self.work_q = queue.Queue(maxsize=16)
+        # emails go out on a thread of their own, so a slow SMTP relay does
+        # not hold up assessing the next packet. one thread is enough as
+        # the relay connection is used serially anyway
+        self.mail_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=f"{self.__class__.__name__}-smtp")
+        self.mail_future = None     # latest flush handed to mail_pool
+        self.worker = threading.Thread(target=self.assess_loop,
+                                       name=self.__class__.__name__,
+                                       daemon=True)
+        self.worker.start()
+
         # start listening to new ARCHIVE packets
         self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
         log.info(f"{self.__class__.__name__}: started (version {version}):"
@@ -215,6 +268,7 @@ class AlarmSvc(StdService):
                  f", {alarm_defs_count - len(self.alarms)} skipped")
 
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def owner_emailaddr():
         """return email address of owner of this weewx instance"""
         return getpass.getuser()    # don't bother with '@server'
@@ -223,32 +277,61 @@ class AlarmSvc(StdService):
         """parse an alarm definition, returning Alarm instance or None"""
 
         if weewx.debug > 2:
-            log.debug(f"{self.__class__.__name__}.parse_alarm"
-                      f" name='{name}' alarm_sect='{alarm_sect}'")
+            log.debug("%s.parse_alarm name='%s' alarm_sect='%s'",
+                      self.__class__.__name__, name, alarm_sect)
 
         # rule
         rule = alarm_sect.get('rule', None)
         if not rule:
-            log.warning(f"{self.__class__.__name__} [{alarm_name}] no rule")
+            log.warning(f"{self.__class__.__name__} [{name}] no rule")
+            return None
+        if isinstance(rule, list):
+            # configobj splits an unquoted value at commas, e.g.
+            # 'max(outTemp, inTemp) >= 30.0', so put it back together
+            rule = ', '.join(rule)
+        if not isinstance(rule, str):
+            # only a str can be compiled, or be a key of its cache
+            log.warning(f"{self.__class__.__name__} [{name}]"
+                        f" invalid rule='{rule}'")
             return None
 
         # on_... sub-sections
-        sect = alarm_sect.get('on_set', None)
-        on_true_params = self.parse_on_sect(sect, defaults, 'set') \
-                         if sect is not None else None
-        sect = alarm_sect.get('on_clear', None)
-        on_false_params = self.parse_on_sect(sect, defaults, 'clear') \
-                          if sect is not None else None
+        on_params = []
+        for on_name, on_state in (('on_set', 'set'), ('on_clear', 'clear')):
+            sect = alarm_sect.get(on_name, None)
+            if sect is not None and not isinstance(sect, dict):
+                # e.g. 'on_set = ...' given as a scalar, not a sub-section
+                log.warning(f"{self.__class__.__name__} [{name}]"
+                            f" {on_name} is not a section: '{sect}'")
+                return None
+            on_params.append(self.parse_on_sect(sect, defaults, on_state)
+                             if sect is not None else None)
+        on_true_params, on_false_params = on_params
+        for on_name, params in (('on_set', on_true_params),
+                                ('on_clear', on_false_params)):
+            for key in ('subject', 'body') if params else ():
+                if params[key].error is not None:
+                    # still assessed - a garbled notification beats none
+                    log.error(f"{self.__class__.__name__} [{name}] {on_name}"
+                              f" invalid {key}: {params[key].error}:"
+                              f" will be sent garbled")
+        if on_true_params is None and on_false_params is None:
+            # nothing would ever be triggered, so don't bother assessing it
+            log.warning(f"{self.__class__.__name__} [{name}]"
+                        f" no on_set or on_clear")
+            return None
 
-        return Alarm(name, rule, on_true_params, on_false_params, mailer)
+        alarm = Alarm(name, rule, on_true_params, on_false_params, mailer)
+        if alarm.rule_func is None:
+            return None     # rule was rejected - alarm would be inert
+        return alarm
 
     def parse_on_sect(self, on_sect, on_defaults, on_state):
         """parse an on_ sub-section in alarm definition"""
 
         # construct raw param dict
-        params = {}
-        for key in on_defaults:
-            params[key] = on_sect[key] if key in on_sect else on_defaults[key]
+        params = {key: on_sect.get(key, default)
+                  for key, default in on_defaults.items()}
 
         # transform global 'notify_first' list to local 'suppress_first' bool
         if 'suppress_first' in on_sect:
@@ -265,6 +348,29 @@ class AlarmSvc(StdService):
             params['suppress_first'] = on_state not in on_defaults['notify_first']
         del params['notify_first']  # remove extraneous parameter
 
+        # configobj splits an unquoted value at commas e.g.
+        # 'body = outTemp {outTemp}, humidity {outHumidity}', so put text
+        # back together
+        for key in ('text_set', 'text_clear', 'subject_prefix', 'subject',
+                    'body_prefix', 'body'):
+            if isinstance(params[key], list):
+                params[key] = ', '.join(params[key])
+
+        # pre-process format strings once here rather than on every trigger.
+        # prefixes are merged in, so remove them as extraneous parameters
+        raw = params['recipients']
+        if isinstance(raw, list):
+            raw = ','.join(raw)
+        recipients = Template(raw)
+        recipients.prerender({})    # static list - no variables to substitute
+        if recipients.rendered is None:
+            log.warning(f"{__class__.__name__}: invalid recipients"
+                        f" raw='{raw}' ignored")
+        params['recipients'] = recipients.rendered
+        params['subject'] = Template(params.pop('subject_prefix') +
+                                     params['subject'])
+        params['body'] = Template(params.pop('body_prefix') + params['body'])
+
         return params
 
     def new_archive_record(self, event):
@@ -272,52 +378,124 @@ class AlarmSvc(StdService):
 
         # we can't unbind as a packet listener, but we can skip responses
         if self.stop.is_set():
-            if weewx.debug > 0:
-                log.debug(f"{self.__class__.__name__}.new_archive_record:"
-                          f" stop.is_set")
+            if weewx.debug > 0 and log.isEnabledFor(logging.DEBUG):
+                log.debug("%s.new_archive_record: stop.is_set",
+                          self.__class__.__name__)
             return
 
-        def assess_all_alarms(packet):
-            """assess all alarms against packet"""
-
-            # convert packet to specified unit_system
-            if weewx.debug > 1:
-                log.debug(f"{self.__class__.__name__}.assess_all_alarms:"
-                          f" ORIG packet={packet}")
+        # hand the assessment off to the worker thread to protect engine
+        # thread. assessment acts independently so don't wait for it
+        try:
+            self.work_q.put_nowait(event.record)
+        except queue.Full:
+            # worker has fallen behind. drop the oldest packet - the newest
+            # matters most
+            log.warning(f"{self.__class__.__name__}: assessment backlog"
+                        f" full, oldest packet dropped")
+            try:
+                self.work_q.get_nowait()
+            except queue.Empty:
+                pass        # worker took it meanwhile
+            self.work_q.put_nowait(event.record)
+
+    def assess_loop(self):
+        """worker thread: assess queued ARCHIVE packets until stopped"""
+
+        while not self.stop.is_set():
+            packet = self.work_q.get()
+            if packet is None or self.stop.is_set():
+                break       # woken by shutDown, or packets left behind it
+            try:
+                self.assess_all_alarms(packet)
+            except Exception as e:
+                # shouldn't happen, but keep the worker alive for next packet
+                log.warning(f"{self.__class__.__name__}: assessment failed",
+                            exc_info=e)
+
+    def assess_all_alarms(self, packet):
+        """assess all alarms against packet"""
+
+        # convert packet to specified unit_system, unless already in it.
+        # packet_cvt may then be the engine's own record, so it is strictly
+        # read-only: alarms layer anything they add (_TIME, _STATE etc) over
+        # it rather than insert it
+        if weewx.debug > 1 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s.assess_all_alarms: ORIG packet=%s",
+                      self.__class__.__name__, packet)
+        if packet.get('usUnits') == self.unit_system:
+            packet_cvt = packet
+        else:
             packet_cvt = weewx.units.to_std_system(packet, self.unit_system)
-            if weewx.debug > 1:
-                log.debug(f"{self.__class__.__name__}.assess_all_alarms:"
-                          f" packet_cvt={packet_cvt}")
+        if weewx.debug > 1 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s.assess_all_alarms: packet_cvt=%s",
+                      self.__class__.__name__, packet_cvt)
 
-            # assess each alarm
-            for alarm in self.alarms:
-                if self.stop.is_set():
-                    # service shutting down...
-                    if weewx.debug > 0:
-                        log.debug(f"{self.__class__.__name__}.assess_all_"
-                                  f"alarms: stop.is_set")
-                    break
-                alarm.assess(packet_cvt)
-
-        # spawn the assessment off into a thread to protect engine thread
+        # timestamp is the same for every alarm, so format it just once
+        time_str = Alarm.epoch_to_string(packet_cvt['dateTime'])
+
+        # assess each alarm. shutdown is only checked between packets (in
+        # assess_loop) since each alarm.assess is short
         try:
-            t = threading.Thread(target=assess_all_alarms, args=(event.record,))
-            t.start()
-        except threading.ThreadError as e:
-            log.warning(f"{self.__class__.__name__}: failed to spawn assessment"
-                        f" thread: {e.args[0]}")
-        # assessment acts independently so don't wait for it to complete
+            for alarm in self.alarms:
+                try:
+                    alarm.assess(packet_cvt, time_str)
+                except Exception as e:
+                    # shouldn't happen, but carry on with the other alarms
+                    log.warning(f"{self.__class__.__name__} [{alarm.name}]"
+                                f" oops", exc_info=e)
+        finally:
+            # send emails triggered by this packet together, in background
+            if self.mailer.outbox:
+                try:
+                    self.mail_future = self.mail_pool.submit(
+                            self.mailer.flush)
+                except RuntimeError:
+                    # mail_pool already shut down, as shutDown gave up
+                    # waiting for this thread
+                    log.warning(f"{self.__class__.__name__}: shutting down,"
+                                f" {self.mailer.discard()} emails not sent")
+                else:
+                    self.mail_future.add_done_callback(self.flush_done)
+
+    def flush_done(self, future):
+        """log any unexpected failure of a background flush, which would
+           otherwise go unseen"""
+
+        if future.cancelled():
+            # by shutDown. its emails stay in the outbox, and are counted as
+            # not sent by whichever of mailer.close() or a flush in progress
+            # gives up on them
+            return
+        if future.exception() is not None:
+            log.error(f"{self.__class__.__name__}: sending emails failed",
+                      exc_info=future.exception())
 
     def shutDown(self):
         """respond to request for graceful shutdown"""
 
         log.info(f"{self.__class__.__name__}: shutdown")
 
-        # no resources to release.
         # cannot unbind as listener
 
-        # do best to stop threads
+        # do best to stop threads. wake the worker if waiting for a packet
         self.stop.set()
+        try:
+            self.work_q.put_nowait(None)
+        except queue.Full:
+            pass        # worker not waiting, and will see stop.is_set
+        # give worker a moment to finish, so it is done with the mailer
+        self.worker.join(timeout=5.0)
+
+        # give emails already being sent a moment too, but no longer lest an
+        # unresponsive relay hold up weewx. emails not yet started are
+        # dropped. (all flushes drain the one outbox, and stop once the
+        # mailer is closing, so only the latest need be cancelled)
+        if self.mail_future is not None:
+            self.mail_future.cancel()
+        self.mail_pool.shutdown(wait=False)
+
+        # release resources
+        self.mailer.close(timeout=5.0)
 
 
 class Alarm:
@@ -326,58 +504,165 @@ class Alarm:
     def __init__(self, name, rule, on_true_params, on_false_params, mailer):
 
         self.name = name
-        self.rule = rule        # TODO consider compiling the string
+        self.rule = rule
+        try:
+            # compile once here rather than re-parse on every evaluation.
+            # rule_args are variables rule needs, in order of rule_func's
+            # parameters
+            self.rule_func, self.rule_args = Alarm.compile_rule(rule)
+        except (SyntaxError, ValueError, TypeError) as e:
+            log.error(f"{self.__class__.__name__} [{self.name}]"
+                      f" invalid rule='{self.rule}': {e}")
+            self.rule_func = None
+            self.rule_args = ()
+        self.rule_names = frozenset(self.rule_args)
+        unsafe = self.rule_names & _UNSAFE_BUILTINS
+        if unsafe:
+            log.error(f"{self.__class__.__name__} [{self.name}]"
+                      f" invalid rule='{self.rule}': builtins not allowed:"
+                      f" {', '.join(sorted(unsafe))}")
+            self.rule_func = None
+        if '_STATE' in self.rule_names:
+            # it would be a missing input on every packet, so the alarm
+            # could never change state
+            log.error(f"{self.__class__.__name__} [{self.name}]"
+                      f" invalid rule='{self.rule}': cannot use _STATE, it"
+                      f" is never defined until after the rule is evaluated")
+            self.rule_func = None
         self.on_true_params = on_true_params
         self.on_false_params = on_false_params
+        # trigger parameters indexed by (bool) state
+        self.params_by_state = (on_false_params, on_true_params)
         self.mailer = mailer
 
+        # special variables that never change, and those the rule uses
+        self.specials = {'_NAME': name, '_RULE': rule}
+        self.rule_specials = self.rule_names & {'_NAME', '_RULE', '_TIME'}
+        # variables that the rule needs the packet to supply
+        self.rule_inputs = self.rule_names - self.rule_specials
+
+        # _NAME, _RULE and each on_ section's _STATE are known now, so
+        # render templates that need nothing more from the packet just once
+        for params, text in ((on_true_params, 'text_set'),
+                             (on_false_params, 'text_clear')):
+            if params:
+                specials = {**self.specials, '_STATE': params[text]}
+                params['subject'].prerender(specials)
+                params['body'].prerender(specials)
+
         self.state = None       # start in unknown state
 
         if weewx.debug > 1:
-            log.debug(f"{self.__class__.__name__} created: [{self.name}]"
-                      f" rule='{self.rule}'"
-                      f" on_true_params={self.on_true_params}"
-                      f" on_false_params={self.on_false_params}"
-                      f" mail={self.mailer} state={self.state}")
+            log.debug("%s created: [%s] rule='%s' on_true_params=%s"
+                      " on_false_params=%s mail=%s state=%s",
+                      self.__class__.__name__, self.name, self.rule,
+                      self.on_true_params, self.on_false_params, self.mailer,
+                      self.state)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def compile_rule(rule):
+        """compile rule into a function of the variables it references,
+           returning the function and the names of its parameters in order.
+           cached, as alarms often share a rule e.g. on a status flag"""
+
+        # compile as is first, for errors that would pass once it is wrapped
+        # in a lambda e.g. 'yield' outside function
+        compile(rule, '<alarm rule>', 'eval')
+        tree = ast.parse(rule, '<alarm rule>', 'eval')
+        names = tuple(sorted(Alarm.referenced_names(rule)))
+        # the rule becomes the body of a lambda taking those variables, so
+        # they are fast locals rather than looked up by name in a dict
+        func = ast.Expression(ast.Lambda(
+                args=ast.arguments(posonlyargs=[],
+                                   args=[ast.arg(arg=name) for name in names],
+                                   kwonlyargs=[], kw_defaults=[], defaults=[]),
+                body=tree.body))
+        code = compile(ast.fix_missing_locations(func), '<alarm rule>', 'eval')
+        return eval(code, _RULE_GLOBALS), names
+
+    @staticmethod
+    def referenced_names(rule):
+        """return names of variables referenced by rule, excluding allowed
+           builtins and names bound within it (e.g. comprehension variables).
+           other builtins are included, for Alarm to reject"""
+
+        # a name is a variable if it is global in the scope that uses it.
+        # scopes matter: in 'x + sum(x for x in xs)' the first x is a
+        # variable but the comprehension's x is not
+        loaded, bound = set(), set()
+        tables = [symtable.symtable(rule, '<alarm rule>', 'eval')]
+        while tables:
+            table = tables.pop()
+            for symbol in table.get_symbols():
+                if symbol.is_global():
+                    if symbol.is_referenced():
+                        loaded.add(symbol.get_name())
+                    if symbol.is_assigned():
+                        bound.add(symbol.get_name())    # e.g. (y := x)
+            tables.extend(table.get_children())
+        # interned, like the packet's keys, for identity-fast dict lookups
+        return frozenset(sys.intern(name)
+                         for name in loaded - bound - _SAFE_BUILTINS.keys())
 
     @staticmethod
     def epoch_to_string(epoch):
         """convert epoch time to string"""
         return timestamp_to_string(epoch)[:19]
 
-    def assess(self, packet_cvt):
+    def assess(self, packet_cvt, time_str):
         """assess alarm by evaluating its rule and triggering if its state has
-           changed. if triggered, it performs associated action, if any"""
-
-        # create evaluation context based on packet values plus the special
-        # variables (_NAME, _RULE, _TIME).
-        # note: special variable _STATE not known until rile has been eval'ed
-        context = {**packet_cvt,
-                   **{'_NAME': self.name, '_RULE': self.rule,
-                      '_TIME': Alarm.epoch_to_string(packet_cvt['dateTime'])}}
-        if weewx.debug > 2:
-            log.debug(f"{self.__class__.__name__}.assess [{self.name}]"
-                      f" context={context}")
+           changed. if triggered, it performs associated action, if any.
+           time_str is packet's dateTime already formatted by epoch_to_string
+        """
+
+        # skip if packet lacks any variable the rule needs, which is common
+        # for sensors that report intermittently. a set test is much cheaper
+        # than raising and catching an exception for it
+        if not self.rule_inputs <= packet_cvt.keys():
+            # so log something only if debug set
+            if weewx.debug > 0 and log.isEnabledFor(logging.DEBUG):
+                missing = self.rule_inputs - packet_cvt.keys()
+                log.debug("%s [%s] rule: not in packet: %s",
+                          self.__class__.__name__, self.name,
+                          ', '.join(sorted(missing)))
+            return      # no new state
+
+        # gather values of just the variables the rule refers to, rather
+        # than the whole packet. special variables (_NAME, _RULE, _TIME) take
+        # precedence over packet values, but are rarely used.
+        # note: special variable _STATE not known until rule has been eval'ed
+        if self.rule_specials:
+            source = collections.ChainMap({**self.specials, '_TIME': time_str},
+                                          packet_cvt)
+        else:
+            source = packet_cvt
+        args = [source[name] for name in self.rule_args]
+        if weewx.debug > 2 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s.assess [%s] context=%s", self.__class__.__name__,
+                      self.name, dict(zip(self.rule_args, args)))
 
         # evaluate rule to get new state
-        new_state = self.eval_rule(context)
-        if weewx.debug > 2:
-            log.debug(f"{self.__class__.__name__}.assess [{self.name}]"
-                      f" state={self.state}->{new_state}")
+        new_state = self.eval_rule(args)
+        if weewx.debug > 2 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s.assess [%s] state=%s->%s", self.__class__.__name__,
+                      self.name, self.state, new_state)
         if new_state is None:
             return      # no new state
+        # state is only ever set or clear, whatever value the rule gave
+        new_state = bool(new_state)
 
         # have we changed state?
         old_state = self.state
-        if new_state == old_state:
+        if new_state is old_state:
             return      # no state change
         self.state = new_state
 
         # get trigger parameters for new state
-        params = self.on_true_params if new_state else self.on_false_params
-        if weewx.debug > 1:
-            log.debug(f"{self.__class__.__name__}.assess [{self.name}]"
-                      f" params={params}")
+        params = self.params_by_state[new_state]
+        if weewx.debug > 1 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s.assess [%s] params=%s", self.__class__.__name__,
+                      self.name, params)
         if not params:
             return      # no trigger defined
 
@@ -387,113 +672,217 @@ class Alarm:
             if params['suppress_first']:
                 return  # suppress notification of first state
 
-        # start assembling the notification
+        # start assembling the notification. its context layers the special
+        # variables over the packet, rather than copying the packet, as the
+        # packet is shared by all alarms
+        context = collections.ChainMap({'_TIME': time_str}, self.specials,
+                                       packet_cvt)
         context['_STATE'] = params['text_set'] if new_state else \
                             params['text_clear']
 
         # recipients
-        raw = params['recipients']
-        if isinstance(raw, list):
-            raw = ','.join(raw)
-        recipients = self.eval_string(raw, {})
+        recipients = params['recipients']
         if not recipients:
             log.warning(f"{self.__class__.__name__}.assess: [{self.name}]"
-                        f" no recipients raw='{raw}'")
+                        f" no recipients")
             return          # finished - no email
 
         # subject
-        raw = params['subject_prefix'] + params['subject']
-        subject = self.eval_string(raw, context)
+        template = params['subject']
+        subject = self.eval_string(template, context)
         if subject is None:
             # fallback subject if garbled
-            subject = f"{self.name} [{context['_STATE']}] *garbled* raw='{raw}'"
+            subject = f"{self.name} [{context['_STATE']}] *garbled*" \
+                      f" raw='{template.raw}'"
 
         # body
-        raw = params['body_prefix'] + params['body']
-        body = self.eval_string(raw, context)
+        template = params['body']
+        body = self.eval_string(template, context)
         if body is None:
             # fallback body if garbled
-            body = f"*garbled* raw='{raw}'"
+            body = f"*garbled* raw='{template.raw}'"
 
         # send email
-        if weewx.debug > 1:
-            log.debug(f"{self.__class__.__name__}.assess: [{self.name}]"
-                      f" recipients='{recipients}'"
-                      f" subject='{subject}' body='{body}'")
+        if weewx.debug > 1 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s.assess: [%s] recipients='%s' subject='%s' body='%s'",
+                      self.__class__.__name__, self.name, recipients, subject,
+                      body)
         self.mailer.send(recipients, subject, body)
 
-    def eval_rule(self, context):
-        """evaluate rule. returns new state, or None if error"""
+    def eval_rule(self, args):
+        """evaluate rule with args, values of variables in order of
+           rule_args. returns new state, or None if error"""
 
         new_state = None
         try:
-            if weewx.debug > 1:
-                log.debug(f"{self.__class__.__name__}.eval_rule [{self.name}]"
-                          f" rule='{self.rule}'")
-            new_state = eval(self.rule, {}, context)
-            if weewx.debug > 1:
-                log.debug(f"{self.__class__.__name__}.eval_rule [{self.name}]"
-                          f" state={new_state}"
-                          f" change?={self.state != new_state}")
-
-        except NameError as e:
-            # common mistake - referenced variable not in packet
-            # so log something only if debug set
-            if weewx.debug > 0:
-                log.debug(f"{self.__class__.__name__} [{self.name}]"
-                          f" rule: {e.args[0]}")
-        except (ValueError, TypeError, KeyError) as e:
-            # common mistake - bad use of a variable in packet
-            # so log an error as this really shouldn't be allowed to happen
+            if weewx.debug > 1 and log.isEnabledFor(logging.DEBUG):
+                log.debug("%s.eval_rule [%s] rule='%s'",
+                          self.__class__.__name__, self.name, self.rule)
+            new_state = self.rule_func(*args)
+            if weewx.debug > 1 and log.isEnabledFor(logging.DEBUG):
+                log.debug("%s.eval_rule [%s] state=%s change?=%s",
+                          self.__class__.__name__, self.name, new_state,
+                          self.state != new_state)
+
+        except (NameError, ValueError, TypeError, KeyError,
+                ArithmeticError) as e:
+            # common mistake - bad use of a variable in packet (or e.g.
+            # divide by a zero reading) so log an error as this really
+            # shouldn't be allowed to happen. missing variables are skipped
+            # before the rule is called, so a NameError is a mistake too
+            # e.g. reading a name before the rule assigns it with :=
             log.warning(f"{self.__class__.__name__} [{self.name}]"
                         f" rule: {e.args[0]}")
-        except Exception as e:
-            # other errors shouldn't happen
-            log.warning(f"{self.__class__.__name__} [{self.name}] rule: oops",
-                        exc_info=e)
+        # other errors shouldn't happen, and are left to assess_all_alarms
 
         return new_state
 
-    def eval_string(self, raw, context):
-        """evaluate raw string i.e. substitute variables and ast.literal_eval"""
+    def eval_string(self, template, context):
+        """evaluate template i.e. substitute variables"""
 
         cooked = None
         try:
-            if weewx.debug > 2:
-                log.debug(f"{self.__class__.__name__}.eval_string:"
-                          f" [{self.name}] raw='{raw}'")
+            if weewx.debug > 2 and log.isEnabledFor(logging.DEBUG):
+                log.debug("%s.eval_string: [%s] raw='%s'",
+                          self.__class__.__name__, self.name, template.raw)
 
             # substitute variables
-            cooked = raw.format_map(context)
-            if weewx.debug > 2:
-                log.debug(f"{self.__class__.__name__}.eval_string:"
-                          f" [{self.name}] substituted cooked='{cooked}'")
-
-            # literal_eval
-            cooked = ast.literal_eval("'" + cooked + "'")
-            if weewx.debug > 2:
-                log.debug(f"{self.__class__.__name__}.eval_string:"
-                          f" [{self.name}] final cooked='{cooked}'")
-
-        except NameError as e:
-            # common mistake - referenced variable not in packet
-            # so log something only if debug set
-            if weewx.debug > 0:
-                log.debug(f"{self.__class__.__name__} [{self.name}]"
-                          f" {e.args[0]}")
-        except (ValueError, TypeError, KeyError) as e:
+            cooked = template.render(context)
+            if weewx.debug > 2 and log.isEnabledFor(logging.DEBUG):
+                log.debug("%s.eval_string: [%s] cooked='%s'",
+                          self.__class__.__name__, self.name, cooked)
+
+        except KeyError as e:
+            # common mistake - referenced variable not in packet (e.g.
+            # sensor offline). leave it unfilled rather than garble the
+            # whole text, so log something only if debug set
+            if weewx.debug > 0 and log.isEnabledFor(logging.DEBUG):
+                log.debug("%s [%s] not in packet: %s",
+                          self.__class__.__name__, self.name, e.args[0])
+            try:
+                cooked = template.render_missing(context)
+            except (LookupError, ValueError, TypeError, AttributeError) as e:
+                log.warning(f"{self.__class__.__name__} [{self.name}]"
+                            f" {e.args[0]}")
+        except (LookupError, ValueError, TypeError, AttributeError) as e:
             # common mistake - bad use of a variable in packet
             # so log an error as this really shouldn't be allowed to happen
             log.warning(f"{self.__class__.__name__} [{self.name}]"
                         f" {e.args[0]}")
-        except Exception as e:
-            # other errors shouldn't happen
-            log.warning(f"{self.__class__.__name__} [{self.name}] oops",
-                        exc_info=e)
+        # other errors shouldn't happen, and are left to assess_all_alarms
 
         return cooked
 
 
+class Template:
+    """format string, pre-processed once at configuration time so that
+       rendering it only needs variables substituted"""
+
+    def __init__(self, raw):
+
+        self.raw = raw
+        self.error = None       # why raw is unusable, if it is
+        try:
+            # interpret backslash escapes (e.g. '\t', '\n') now, not per
+            # render. 'backslashreplace' carries non-latin-1 characters
+            # through the codec
+            if '\\' in raw:
+                self.text = raw.encode('latin-1', 'backslashreplace') \
+                               .decode('unicode_escape')
+            else:
+                self.text = raw     # no escapes, so nothing to interpret
+            parsed = list(string.Formatter().parse(self.text))
+        except ValueError as e:
+            # e.g. stray '}' or bad '\x' escape. keep it, so that render()
+            # fails and the alarm still notifies, if garbled
+            self.error = str(e)
+            self.text, parsed = raw, []
+
+        # re-express as a positional format string with one numbered slot
+        # per field e.g. 'T={outTemp:.1f}' becomes 'T={0:.1f}' with slot
+        # 'outTemp', so rendering only has to look each variable up once.
+        # fields that are positional or have nested fields in their
+        # format_spec are left to format_map (slots None).
+        # fields are names of variables referenced e.g. 'outTemp'.
+        # parts keep each field's own format and original text, for
+        # render_missing()
+        pieces, slots, fields, parts = [], [], set(), []
+        for literal, field, spec, conversion in parsed:
+            pieces.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                parts.append((literal, None, None, None))
+                continue
+            name = sys.intern(field.partition('.')[0].partition('[')[0])
+            if name:
+                fields.add(name)
+            if slots is not None and name.isidentifier() and '{' not in spec:
+                conversion = '!' + conversion if conversion else ''
+                spec = ':' + spec if spec else ''
+                pieces.append(f"{{{len(slots)}{field[len(name):]}"
+                              f"{conversion}{spec}}}")
+                parts.append((literal, name,
+                              f"{{0{field[len(name):]}{conversion}{spec}}}",
+                              f"{{{field}{conversion}{spec}}}"))
+                slots.append(name)
+            else:
+                slots = None
+        self.positional = ''.join(pieces) if slots is not None else None
+        self.slots = tuple(slots) if slots is not None else None
+        self.parts = tuple(parts) if slots is not None else None
+        self.fields = frozenset(fields)
+        self.rendered = None    # result, if it can be known in advance
+
+    def __repr__(self):
+        return repr(self.raw)
+
+    def prerender(self, context):
+        """if every variable referenced is in context, render now so that
+           later renders just return the result"""
+
+        if self.error is None and self.fields <= context.keys():
+            try:
+                self.rendered = self.text.format_map(context)
+            except (LookupError, ValueError, TypeError, AttributeError):
+                pass    # leave it to render() to report
+
+    def render(self, context):
+        """return text with variables substituted from context"""
+
+        if self.error is not None:
+            raise ValueError(self.error)
+        if self.rendered is not None:
+            return self.rendered
+        if self.slots is None:
+            return self.text.format_map(context)
+        return self.positional.format(*[context[name] for name in self.slots])
+
+    def render_missing(self, context):
+        """as render(), but variables not in context are left as their
+           original '{field}' text rather than failing"""
+
+        if self.error is not None:
+            raise ValueError(self.error)
+        if self.parts is None:
+            return self.text.format_map(_ShowMissing(context))
+        cooked = []
+        for literal, name, fmt, field in self.parts:
+            cooked.append(literal)
+            if name is None:
+                pass    # trailing text, no field
+            elif name in context:
+                cooked.append(fmt.format(context[name]))
+            else:
+                cooked.append(field)
+        return ''.join(cooked)
+
+
+class _ShowMissing(collections.ChainMap):
+    """context that gives a missing variable as its own '{name}' text"""
+
+    def __missing__(self, key):
+        return f"{{{key}}}"
+
+
 class Mailer:
     """knows how to send email messages"""
 
@@ -510,32 +899,143 @@ class Mailer:
         self.password = password    # not used
         self.sender = sender
 
+        # emails waiting for flush(), as (subject, to_addrs, msg)
+        self.outbox = collections.deque()
+        self.smtp = None                # connection kept open between sends
+        self.timeout = 10.0             # secs, so a hung relay can't block
+        self.lock = threading.Lock()    # serialises use of connection
+        self.closing = threading.Event()    # set by close(), stops flush()
+
         if weewx.debug > 1:
-            log.debug(f"{self.__class__.__name__} created:"
-                      f" server={self.server} user={self.user}"
-                      f" password={self.password} sender={self.sender}")
+            log.debug("%s created: server=%s user=%s password=%s sender=%s",
+                      self.__class__.__name__, self.server, self.user,
+                      self.password, self.sender)
 
     def send(self, recipients, subject, body):
+        """queue an email, to be sent by the next flush()"""
 
         # compose email
         envelope = MIMEText(f'{body}\n')
         envelope['Subject'] = subject
         envelope['From'] = self.sender
         envelope['To'] = recipients
-        if weewx.debug > 1:
-            log.debug(f"{self.__class__.__name__}.send: envelope='{envelope}'")
+        if weewx.debug > 1 and log.isEnabledFor(logging.DEBUG):
+            log.debug("%s.send: envelope='%s'", self.__class__.__name__,
+                      envelope)
+
+        # serialise now, so an email that can't be (e.g. a newline in its
+        # subject) fails here for its own alarm alone, not in flush() for
+        # every email queued with it.
+        # every recipient address, not the whole 'To' header as one address
+        to_addrs = [addr for _, addr in getaddresses([recipients]) if addr]
+        self.outbox.append((subject, to_addrs, envelope.as_string()))
+
+    def flush(self):
+        """send all queued emails, in the one SMTP session"""
+
+        if not self.outbox:
+            return      # nothing to send
+
+        # send them via relay. assumes no authentication required
+        with self.lock:
+            connected = False
+            while self.outbox and not self.closing.is_set():
+                if not connected:
+                    try:
+                        self.connect()
+                        connected = True
+                    except (smtplib.SMTPException, OSError) as e:
+                        # relay unavailable, so don't wait on it again for
+                        # each of the rest
+                        # (only those queued so far - send() may be adding
+                        # the next packet's meanwhile)
+                        log.error(f"{self.__class__.__name__}:"
+                                  f" SMTP connect failed: {e}:"
+                                  f" {self.discard()} emails not sent")
+                        self.disconnect()
+                        break
+                subject, to_addrs, msg = self.outbox.popleft()
+                try:
+                    self.send_one(to_addrs, msg)
+                    log.info(f"{self.__class__.__name__}:"
+                             f" sent: {subject}")
+                except (smtplib.SMTPException, OSError) as e:
+                    log.error(f"{self.__class__.__name__}:"
+                              f": SMTP send failed: {e.args[0]}:"
+                              f" {subject}")
+                    self.disconnect()   # start afresh for next email
+                    connected = False
+            if self.closing.is_set() and self.outbox:
+                # stopped by close() while still sending
+                log.warning(f"{self.__class__.__name__}: closing,"
+                            f" {self.discard()} emails not sent")
+
+    def send_one(self, to_addrs, msg):
+        """send one serialised email over the current connection,
+           reconnecting once if the relay has dropped it. caller holds lock"""
+
+        try:
+            self.smtp.sendmail(self.sender, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            # relay dropped connection. reconnect and retry once
+            self.smtp = None
+            self.connect()
+            self.smtp.sendmail(self.sender, to_addrs, msg)
+
+    def connect(self):
+        """ensure there is a live connection to the relay, reusing the
+           existing connection if it still responds. caller holds lock"""
+
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return      # still alive
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self.disconnect()
+        self.smtp = smtplib.SMTP(self.server, timeout=self.timeout)
 
-        # send it via relay. assumes no authentication required
-        smtp = None
+    def disconnect(self):
+        """drop connection to the relay, if any. caller holds lock"""
+
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass        # going anyway
+            self.smtp = None
+
+    def close(self, timeout=-1):
+        """release connection to the relay, giving a flush in progress up
+           to timeout secs to finish first"""
+
+        if not self.lock.acquire(timeout=timeout):
+            # still sending. stop after the current email, and leave the
+            # connection for process exit
+            self.closing.set()
+            return
         try:
-            smtp = smtplib.SMTP(self.server)
-            smtp.sendmail(
-                    envelope['From'], envelope['To'], envelope.as_string())
-            log.info(f"{self.__class__.__name__}: sent: {subject}")
-        except smtplib.SMTPException as e:
-            log.error(f"{self.__class__.__name__}:"
-                      f": SMTP send failed: {e.args[0]}: {subject}")
+            self.closing.set()
+            self.disconnect()
+            if self.outbox:
+                # no flush will send these now
+                log.warning(f"{self.__class__.__name__}: closing,"
+                            f" {self.discard()} emails not sent")
         finally:
-            if smtp:
-                smtp.quit()
+            self.lock.release()
+
+    def discard(self):
+        """drop emails waiting in the outbox, returning how many. only
+           those there now, not any queued meanwhile by send(). safe without
+           lock, as when shutDown gave up waiting for the worker, though
+           then another thread may drop (or send) some of them first"""
+
+        dropped = 0
+        for _ in range(len(self.outbox)):
+            try:
+                self.outbox.popleft()
+            except IndexError:
+                break   # emptied meanwhile by another thread
+            dropped += 1
+        return dropped
 